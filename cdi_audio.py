@@ -2,16 +2,24 @@
 # Slightly modified from https://github.com/roysmeding/cditools/blob/master/cdi_decode_audio.py
 # (Commit bd69b78)
 
+import sys
 import wave
+import array
 import dataclasses
 
-from typing import TYPE_CHECKING, Tuple, List
+from typing import TYPE_CHECKING, Tuple, List, Optional
 
 if TYPE_CHECKING:
     from cdi_filesystem import CdiSector
 
-# a lookup list for the index of each parameter byte in the sound group header
-PARAM_IDX = range(4, 12)
+# output samples are clipped to the signed 16-bit range
+_SAMPLE_MIN = -2**15
+_SAMPLE_MAX = 2**15-1
+
+# Check that the repeated parameter bytes in every sound group header agree.
+# This only validates the format, so it's skipped under `python -O`, and can
+# be turned off by hand when decoding a lot of known-good audio.
+_VALIDATE_HEADERS = __debug__
 
 @dataclasses.dataclass
 class Encoding:
@@ -26,12 +34,14 @@ class ADPCMDec:
         self.delayed1 = 0.     # two delay lines
         self.delayed2 = 0.
         self.G        = 0      # gain
+        self._gain    = 1.     # 2**G, cached by set_params
         self.K0       = 0.     # first order filter coefficient
         self.K1       = 0.     # second order filter coefficient
 
     def set_params(self, G, F):
         # set range (exponential gain) value
         self.G = int(G)
+        self._gain = 2.**self.G
 
         # set predictor filter
         if F == 0:
@@ -54,113 +64,192 @@ class ADPCMDec:
         self.delayed2 = 0.
 
     def propagate(self, data):
-        output = data * 2.**self.G  +  self.delayed1 * self.K0  +  self.delayed2 * self.K1
-        output = max(-2**15, min(2**15-1, int(output)))
+        output = int(data * self._gain  +  self.delayed1 * self.K0  +  self.delayed2 * self.K1)
+        if output < _SAMPLE_MIN:
+            output = _SAMPLE_MIN
+        elif output > _SAMPLE_MAX:
+            output = _SAMPLE_MAX
         self.delayed2 = self.delayed1
         self.delayed1 = output
         return output
 
+    def propagate_block(self, data, out, pos, step=1):
+        """
+        Decode a run of samples that all share the current range and filter.
+
+        The samples are written into `out`, starting at index `pos` and
+        moving `step` places each time, so stereo channels can be
+        interleaved in place.
+        """
+        self.delayed1, self.delayed2 = _decode_subblock(
+            data, self._gain, self.K0, self.K1, self.delayed1, self.delayed2, out, pos, step)
+
+
+def _decode_subblock(data, gain, K0, K1, delayed1, delayed2, out, pos, step):
+    "Decode samples into `out[pos::step]`. Returns the new values of the two delay lines."
+    lo = _SAMPLE_MIN
+    hi = _SAMPLE_MAX
+    for d in data:
+        output = int(d * gain  +  delayed1 * K0  +  delayed2 * K1)
+        if output < lo:
+            output = lo
+        elif output > hi:
+            output = hi
+        delayed2 = delayed1
+        delayed1 = output
+        out[pos] = output
+        pos += step
+    return delayed1, delayed2
 
 def _sign_extend(v):
     "Convert 4-bit two's complement to python int"
-    if v & (1<<3):
-        return (v & ~(1<<3)) - (1<<3)
-    else:
-        return v
+    return (v ^ (1<<3)) - (1<<3)
 
 def _extract_params(p):
     "Extract ADPCM parameters (range, filter) from byte."
     return p & 0b00001111, ( p & 0b11110000) >> 4
 
-def _extract_chans(d):
-    "Extract channel data (left, right) from byte"
-    return _sign_extend(d & 0b00001111), _sign_extend((d & 0b11110000) >> 4)
-
-def getRawSamples(sectors: List["CdiSector"], channelMask: int) -> Tuple[List[int], Encoding]:
-    encoding = None
-    outsamples = []
+# Lookup tables mapping a data byte to its sign-extended low nibble, high
+# nibble, or the whole byte as a signed 8-bit value.
+_NIBBLE_LO = tuple(_sign_extend(b & 0b00001111) for b in range(256))
+_NIBBLE_HI = tuple(_sign_extend((b & 0b11110000) >> 4) for b in range(256))
+_INT8 = tuple(b - 256 if b & 0x80 else b for b in range(256))
+
+def _extract_chans(data):
+    "Extract channel data (left, right) from every byte in `data`"
+    return list(map(_NIBBLE_LO.__getitem__, data)), list(map(_NIBBLE_HI.__getitem__, data))
+
+# Each of these decodes the 18 sound groups of one sector into `out[pos:]`,
+# and returns the position after the last sample written. Slices of the
+# memoryview they're given don't copy.
+
+def _decode_8bit_mono(sector_data, decoders, out, pos):
+    "Level A audio."
+    decoder, = decoders
+    for group in range(18):
+        sound_group = sector_data[group * 128:(group + 1) * 128]
+        if _VALIDATE_HEADERS:
+            assert sound_group[0:4] == sound_group[4:8] == sound_group[8:12] == sound_group[12:16]
+
+        for unit in range(4):
+            R, F = _extract_params(sound_group[unit])
+            decoder.set_params(8-R, F)
+            # The 28 data bytes for a unit are every 4th byte after the header.
+            decoder.propagate_block(map(_INT8.__getitem__, sound_group[16+unit::4]), out, pos)
+            pos += 28
+    return pos
+
+def _decode_4bit_mono(sector_data, decoders, out, pos):
+    "Level B or C audio, one channel."
+    decoder, = decoders
+    for group in range(18):
+        sound_group = sector_data[group * 128:(group + 1) * 128]
+        if _VALIDATE_HEADERS:
+            assert sound_group[0:4]  == sound_group[4:8]
+            assert sound_group[8:12] == sound_group[12:16]
+
+        # the 4-bit parameter bytes start at offset 4 of the sound group header
+        for unit in range(8):
+            R, F = _extract_params(sound_group[4 + unit])
+            decoder.set_params(12-R, F)
+
+            # Even units use the low nibbles, odd units the high ones.
+            D = map((_NIBBLE_LO, _NIBBLE_HI)[unit % 2].__getitem__, sound_group[16+(unit//2)::4])
+            decoder.propagate_block(D, out, pos)
+            pos += 28
+    return pos
+
+def _decode_4bit_stereo(sector_data, decoders, out, pos):
+    "Level B or C audio, two interleaved channels."
+    decoder_l, decoder_r = decoders
+    for group in range(18):
+        sound_group = sector_data[group * 128:(group + 1) * 128]
+        if _VALIDATE_HEADERS:
+            assert sound_group[0:4]  == sound_group[4:8]
+            assert sound_group[8:12] == sound_group[12:16]
+
+        for unit in range(4):
+            R1, F1 = _extract_params(sound_group[4 + unit*2])
+            R2, F2 = _extract_params(sound_group[5 + unit*2])
+            decoder_l.set_params(12-R1, F1)
+            decoder_r.set_params(12-R2, F2)
+
+            D1, D2 = _extract_chans(sound_group[16+unit::4])
+            decoder_l.propagate_block(D1, out, pos, 2)
+            decoder_r.propagate_block(D2, out, pos + 1, 2)
+            pos += 56
+    return pos
+
+# The encoding is the same for a whole file, so the decoder is picked once,
+# keyed by (sample width, stereo).
+_SECTOR_DECODERS = {
+    (8, False): _decode_8bit_mono,
+    (4, False): _decode_4bit_mono,
+    (4, True): _decode_4bit_stereo,
+}
+
+def _parse_encoding(coding: int) -> Encoding:
+    "Decode the coding byte from an audio sector's subheader."
+    assert not (coding & (1<<5)), "Reserved sample width specified in encoding"
+    sample_width = 8 if (coding & (1<<4)) else 4
+
+    assert not (coding & (1<<3)), "Reserved sample rate specified in encoding"
+    sample_rate  = 18900 if (coding & (1<<2)) else 37800
+
+    assert not (coding & (1<<1)), "Reserved channel number specified in encoding"
+    stereo = True if (coding & (1<<0)) else False
+
+    return Encoding(sample_rate, sample_width, stereo)
+
+def _select_audio_sectors(sectors: List["CdiSector"], channelMask: Optional[int]) -> List["CdiSector"]:
+    "The audio sectors in `channelMask`, up to and including the first record end."
+    # A CdiSectorList can do this from its columns without building every sector.
+    if hasattr(sectors, "selectAudioRecord"):
+        return sectors.selectAudioRecord(channelMask)
+
+    audio_sectors: List["CdiSector"] = []
     for sector in sectors:
         if sector.kind != "audio":
             continue
         if channelMask == None:
             channelMask = 1 << sector.channel
-        elif (1 << sector.channel) & channelMask == 0:
+        elif not (channelMask >> sector.channel) & 1:
             continue
-
-        # determine encoding
-        if encoding is None:
-            encoding = sector.coding
-            assert not (sector.coding & (1<<5)), "Reserved sample width specified in encoding"
-            sample_width = 8 if (sector.coding & (1<<4)) else 4
-
-            assert not (sector.coding & (1<<3)), "Reserved sample rate specified in encoding"
-            sample_rate  = 18900 if (sector.coding & (1<<2)) else 37800
-
-            assert not (sector.coding & (1<<1)), "Reserved channel number specified in encoding"
-            stereo = True if (sector.coding & (1<<0)) else False
-
-            if stereo:
-                decoder_l = ADPCMDec()
-                decoder_r = ADPCMDec()
-            else:
-                decoder = ADPCMDec()
-
-            #print("%dHz, %dbit, %s "%(sample_rate, sample_width, "stereo" if stereo else "mono"))
-        else:
-            assert encoding == sector.coding, "Entire file must have same encoding"
-        
-        # read sound groups in sector
-        for group in range(18):
-            sound_group   = sector.data[group * 128:(group + 1) * 128]
-
-            if sample_width == 8:
-                for i in range(4):
-                    for j in range(1, 4):
-                        assert sound_group[i] == sound_group[i + 4 * j]
-
-                # level A audio
-                for unit in range(4):
-                    R, F = _extract_params(sound_group[unit])
-                    decoder.set_params(8-R, F)
-                    for sample in range(28):
-                        D = ord(sound_group[16+unit+4*sample])
-                        outsamples.append(decoder.propagate(D))
-
-            elif sample_width == 4:
-                # level B or C audio
-                for i in range(4):
-                    assert sound_group[i]   == sound_group[i+4]
-                    assert sound_group[i+8] == sound_group[i+12]
-
-                if stereo:
-                    for unit in range(4):
-                        R1, F1 = _extract_params(sound_group[PARAM_IDX[unit*2]])
-                        R2, F2 = _extract_params(sound_group[PARAM_IDX[unit*2+1]])
-                        decoder_l.set_params(12-R1, F1)
-                        decoder_r.set_params(12-R2, F2)
-
-                        for sample in range(28):
-                            D1, D2 = _extract_chans(sound_group[16+unit+4*sample])
-                            outsamples.append(decoder_l.propagate(D1))
-                            outsamples.append(decoder_r.propagate(D2))
-
-                else:
-                    for unit in range(8):
-                        R, F = _extract_params(sound_group[PARAM_IDX[unit]])
-                        decoder.set_params(12-R, F)
-
-                        for sample in range(28):
-                            D1, D2 = _extract_chans(sound_group[16+(unit//2)+4*sample])
-                            if unit%2 == 0:
-                                outsamples.append(decoder.propagate(D1))
-                            else:
-                                outsamples.append(decoder.propagate(D2))
+        audio_sectors.append(sector)
         if sector.isEndOfRecord:
             break
-    if len(outsamples) == 0:
-        return outsamples, None
-    else:
-        return outsamples, Encoding(sample_rate, sample_width, stereo)
+    return audio_sectors
+
+def getRawSamples(sectors: List["CdiSector"], channelMask: int) -> Tuple["array.array[int]", Optional[Encoding]]:
+    # First pass: find the audio sectors to decode, so the output can be
+    # allocated once instead of growing one sample at a time. This is also
+    # the only place that looks at sector kinds, channels and record ends.
+    audio_sectors = _select_audio_sectors(sectors, channelMask)
+
+    if len(audio_sectors) == 0:
+        return array.array('h'), None
+
+    # determine encoding
+    coding = audio_sectors[0].coding
+    assert all(sector.coding == coding for sector in audio_sectors), "Entire file must have same encoding"
+    encoding = _parse_encoding(coding)
+    sample_width = encoding.sample_width
+    stereo = encoding.stereo
+    #print("%dHz, %dbit, %s "%(encoding.sample_rate, sample_width, "stereo" if stereo else "mono"))
+
+    decode = _SECTOR_DECODERS.get((sample_width, stereo))
+    if decode == None:
+        raise ValueError("8-bit stereo audio is not supported")
+    decoders = (ADPCMDec(), ADPCMDec()) if stereo else (ADPCMDec(),)
+
+    # Every sound group holds 112 samples at 8 bits, or 224 samples at 4 bits.
+    samples_per_group = 112 if sample_width == 8 else 224
+    outsamples = array.array('h', bytes(2 * len(audio_sectors) * 18 * samples_per_group))
+    pos = 0
+
+    for sector in audio_sectors:
+        pos = decode(memoryview(sector.data), decoders, outsamples, pos)
+    return outsamples, encoding
 
 def saveSoundFile(sectors: List["CdiSector"], channelMask: int, fileName: str) -> bool:
     """
@@ -179,7 +268,10 @@ def saveSoundFile(sectors: List["CdiSector"], channelMask: int, fileName: str) -
     outfile.setnchannels(2 if encoding.stereo else 1)
     outfile.setsampwidth(2)
     outfile.setframerate(encoding.sample_rate)
-    sampleByteStream = b"".join([(s & 0xFFFF).to_bytes(2, "little") for s in samples])
+    # WAV samples are little-endian; the array is in native byte order.
+    if sys.byteorder != "little":
+        samples.byteswap()
+    sampleByteStream = samples.tobytes()
     outfile.writeframes(sampleByteStream)
     outfile.close()
 
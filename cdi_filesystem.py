@@ -1,60 +1,151 @@
+import array
+import copy
+import itertools
 import json
 import datetime
+import functools
 import math
+import operator
 import struct
-from typing import Dict, Literal, List, Optional
+from typing import Dict, Literal, List, NamedTuple, Optional
 
 from tqdm import tqdm_notebook as tqdm
 from struct_stream import StructStream
 
+# The 16-byte header at the start of a disk file: raw data offset, JSON length.
+_DISK_HEADER = struct.Struct("QQ")
+
+# Mode 2 sector data starts after the 8-byte subheader (stored twice), and is 2048 bytes in form 1 or 2324
+# bytes in form 2.
+_SUBHEADER_SIZE = 8
+_FORM1_END = _SUBHEADER_SIZE + 2048
+_FORM2_END = _SUBHEADER_SIZE + 2324
+
+# Maps a submode byte to 1 if it marks an audio sector, or 0 otherwise.
+_AUDIO_SUBMODES = bytes(1 if submode & 0x04 else 0 for submode in range(256))
+
+# The start of an OS-9 module header: sync bytes, revision, module size, owner, name pointer.
+# Only the size and the name pointer are kept.
+_MODULE_HEADER = struct.Struct(">4xI4xI")
+
+# OS-9 module headers end with a parity word, chosen so that the first 24 words XOR to 0xFFFF.
+_MODULE_PARITY = struct.Struct(">24H")
+
+def _isModuleHeader(buf: memoryview, offset: int) -> bool:
+	if offset + _MODULE_PARITY.size > len(buf):
+		return False
+	return functools.reduce(operator.xor, _MODULE_PARITY.unpack_from(buf, offset)) == 0xFFFF
+
+# Sector kind for the video (0x02), audio (0x04), and data (0x08) submode bits, indexed by `(submode >> 1) & 7`.
+# Only one of them should be set.
+_KINDS = tuple(
+	"data" if bits & 0x04 else "audio" if bits & 0x02 else "video" if bits & 0x01 else "empty"
+	for bits in range(8)
+)
+
+class _Submode(NamedTuple):
+	isEof: Optional[bool]
+	isRealtime: Optional[bool]
+	form: Optional[int]
+	isTrigger: Optional[bool]
+	kind: Optional[str]
+	isEndOfRecord: Optional[bool]
+
+def _decodeSubmode(submode: int) -> _Submode:
+	return _Submode(
+		isEof = submode & 0x80 != 0,
+		isRealtime = submode & 0x40 != 0,
+		form = ((submode & 0x20) >> 5) + 1,
+		isTrigger = submode & 0x10 != 0,
+		kind = _KINDS[(submode >> 1) & 0x07],
+		isEndOfRecord = submode & 0x01 != 0,
+	)
+
+# Every submode byte, already decoded, so sectors don't repeat the bit tests.
+_SUBMODE_TABLE = tuple(_decodeSubmode(submode) for submode in range(256))
+
+# Mode 1 sectors have no submode.
+_NO_SUBMODE = _Submode(None, None, None, None, None, None)
+
 class CdiSector:
-	def __init__(self, metadata: dict, rawData: bytes):
-		self.minute: int = metadata["minute"]
-		self.second: int = metadata["second"]
-		self.frame: int = metadata["frame"]
-		if metadata["mode"] == "MODE1":
-			self.mode = 1
-		else:
-			assert metadata["mode"] == "MODE2"
-			self.mode = 2
-		
-		if self.mode == 2:
-			assert rawData[:4] == rawData[4:8]
-			self.file = rawData[0]
-			self.channel = rawData[1]
-			submode = rawData[2]
-			self.coding = rawData[3]
-			
-			self.isEof = submode & 0x80 != 0
-			self.isRealtime = submode & 0x40 != 0
-			self.form = ((submode & 0x20) >> 5) + 1
-			self.isTrigger = submode & 0x10 != 0
-			self.kind: Literal["empty", "data", "audio", "video"] = 'empty'
-			if submode & 0x08 != 0:
-				self.kind = "data"
-			if submode & 0x04 != 0:
-				assert self.kind == 'empty'
-				self.kind = "audio"
-			if submode & 0x02 != 0:
-				assert self.kind == 'empty'
-				self.kind = "video"
-			self.isEndOfRecord = submode & 0x01 != 0
-			
-			if self.form == 1:
-				self.data = rawData[8:8 + 2048]
-			else:
-				self.data = rawData[8:8 + 2324]
-		else:
-			self.file = None
-			self.channel = None
-			self.coding = None
-			self.isEof = None
-			self.isRealtime = None
-			self.form = None
-			self.isTrigger = None
-			self.kind = None
-			self.isEndOfRecord = None
-			self.data = rawData
+	"""
+	One sector of a `CdiSectorList`. Fields are read from the list's columns when they're accessed, so a sector
+	only stores where it is.
+	
+	The mode 2 fields (file, channel, coding, and everything from the submode) are None for mode 1 sectors.
+	"""
+	__slots__ = ("_sectors", "_index")
+	
+	def __init__(self, sectors: "CdiSectorList", index: int):
+		self._sectors = sectors
+		self._index = index
+	
+	@property
+	def minute(self) -> int:
+		return self._sectors.minutes[self._index]
+	
+	@property
+	def second(self) -> int:
+		return self._sectors.seconds[self._index]
+	
+	@property
+	def frame(self) -> int:
+		return self._sectors.frames[self._index]
+	
+	@property
+	def mode(self) -> int:
+		return self._sectors.modes[self._index]
+	
+	def _subheaderField(self, column: bytearray) -> Optional[int]:
+		if self._sectors.modes[self._index] != 2:
+			return None
+		return column[self._index]
+	
+	def _submode(self) -> "_Submode":
+		if self._sectors.modes[self._index] != 2:
+			return _NO_SUBMODE
+		return _SUBMODE_TABLE[self._sectors.submodes[self._index]]
+	
+	@property
+	def file(self) -> Optional[int]:
+		return self._subheaderField(self._sectors.files)
+	
+	@property
+	def channel(self) -> Optional[int]:
+		return self._subheaderField(self._sectors.channels)
+	
+	@property
+	def coding(self) -> Optional[int]:
+		return self._subheaderField(self._sectors.codings)
+	
+	@property
+	def isEof(self) -> Optional[bool]:
+		return self._submode().isEof
+	
+	@property
+	def isRealtime(self) -> Optional[bool]:
+		return self._submode().isRealtime
+	
+	@property
+	def form(self) -> Optional[int]:
+		return self._submode().form
+	
+	@property
+	def isTrigger(self) -> Optional[bool]:
+		return self._submode().isTrigger
+	
+	@property
+	def kind(self) -> Optional[Literal["empty", "data", "audio", "video"]]:
+		return self._submode().kind
+	
+	@property
+	def isEndOfRecord(self) -> Optional[bool]:
+		return self._submode().isEndOfRecord
+	
+	@property
+	def data(self) -> memoryview:
+		"""The sector's payload, as a view of the disk blob."""
+		return self._sectors.payload(self._index)
 	
 	def __repr__(self) -> str:
 		ret = "CdiSector(({}m, {}s, {}f), ".format(self.minute, self.second, self.frame)
@@ -71,13 +162,124 @@ class CdiSector:
 				ret += ", Trigger"
 		return ret + ")"
 
+class CdiSectorList:
+	"""
+	All the sectors of a disk, stored as parallel columns rather than one object per sector.
+	
+	Indexing builds (and caches) a `CdiSector` for that position. Slicing with a step of 1 returns another
+	`CdiSectorList` sharing the same columns, so a file's sectors can be taken without building any of them.
+	"""
+	def __init__(self, metadata: List[dict], blob: memoryview):
+		count = len(metadata)
+		self.blob = blob
+		# Sector data is handed out as slices of this view, which don't copy.
+		self._view = memoryview(blob)
+		self.minutes = bytearray(count)
+		self.seconds = bytearray(count)
+		self.frames = bytearray(count)
+		self.modes = bytearray(count)
+		self.offsets = array.array('Q', bytes(8 * count))
+		self.lengths = array.array('I', bytes(4 * count))
+		
+		# Mode 2 subheader fields. These stay 0 for mode 1 sectors.
+		self.files = bytearray(count)
+		self.channels = bytearray(count)
+		self.submodes = bytearray(count)
+		self.codings = bytearray(count)
+		
+		self._cache: List[Optional[CdiSector]] = [None] * count
+		self._start = 0
+		self._stop = count
+		
+		for i, sector in enumerate(tqdm(metadata, desc = "building sectors")):
+			self.minutes[i] = sector["minute"]
+			self.seconds[i] = sector["second"]
+			self.frames[i] = sector["frame"]
+			offset = self.offsets[i] = sector["dataOffset"]
+			self.lengths[i] = sector["dataLength"]
+			if sector["mode"] == "MODE1":
+				self.modes[i] = 1
+				continue
+			assert sector["mode"] == "MODE2"
+			self.modes[i] = 2
+			
+			subheader = self._view[offset:offset + _SUBHEADER_SIZE]
+			assert subheader[:4] == subheader[4:]
+			self.files[i], self.channels[i], self.submodes[i], self.codings[i] = subheader[:4]
+			
+			# At most one of the data, audio, and video bits may be set.
+			assert (subheader[2] & 0x0E) in (0x00, 0x08, 0x04, 0x02)
+	
+	def __len__(self) -> int:
+		return self._stop - self._start
+	
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(len(self))
+			if step != 1:
+				return [self[i] for i in range(start, stop, step)]
+			view = copy.copy(self)
+			view._start = self._start + start
+			view._stop = self._start + max(start, stop)
+			return view
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("sector index out of range")
+		return self._sector(self._start + index)
+	
+	def __iter__(self):
+		for i in range(self._start, self._stop):
+			yield self._sector(i)
+	
+	def _sector(self, index: int) -> CdiSector:
+		"""Builds the sector at `index` in the columns, ignoring this view's bounds."""
+		sector = self._cache[index]
+		if sector == None:
+			sector = self._cache[index] = CdiSector(self, index)
+		return sector
+	
+	def payload(self, index: int) -> memoryview:
+		"""The data of the sector at `index` in the columns, ignoring this view's bounds."""
+		offset = self.offsets[index]
+		end = offset + self.lengths[index]
+		if self.modes[index] != 2:
+			return self._view[offset:end]
+		dataEnd = offset + (_FORM2_END if self.submodes[index] & 0x20 else _FORM1_END)
+		return self._view[offset + _SUBHEADER_SIZE:min(end, dataEnd)]
+	
+	def payloads(self) -> List[memoryview]:
+		"""The data of every sector in this view, without building any `CdiSector`s."""
+		return [self.payload(i) for i in range(self._start, self._stop)]
+	
+	def selectAudioRecord(self, channelMask: Optional[int]) -> List[CdiSector]:
+		"""
+		The audio sectors on any channel in `channelMask`, up to and including the first one that ends a record.
+		If `channelMask` is None, only the channel of the first audio sector is used.
+		
+		This only looks at the columns, so sectors that aren't selected are never built.
+		"""
+		channels = self.channels
+		submodes = self.submodes
+		candidates = itertools.compress(range(self._start, self._stop), submodes[self._start:self._stop].translate(_AUDIO_SUBMODES))
+		ret = []
+		for i in candidates:
+			if channelMask == None:
+				channelMask = 1 << channels[i]
+			elif not (channelMask >> channels[i]) & 1:
+				continue
+			ret.append(self._sector(i))
+			if submodes[i] & 0x01:
+				break
+		return ret
+
 class CdiVolumeDescriptor:
 	def __init__(self, sector: CdiSector):
 		assert sector.mode == 2
 		assert sector.form == 1
 		assert sector.isEndOfRecord
 		
-		s = StructStream(sector.data, endianPrefix=">")
+		s = StructStream(bytes(sector.data), endianPrefix=">")
 		assert s.takeRaw(1)[0] == 1 # Record Type = Standard Volume Structure
 		assert s.takeRaw(5) == b'CD-I ' # Standard Id
 		assert s.takeRaw(1)[0] == 1 # Version = 1
@@ -107,7 +309,7 @@ class CdiVolumeDescriptor:
 
 class CdiDirectory:
 	def __init__(self, sector: CdiSector):
-		s = StructStream(sector.data, endianPrefix=">")
+		s = StructStream(bytes(sector.data), endianPrefix=">")
 		
 		# The first file entry is self-describing.
 		self.thisDescriptor = CdiFile(s)
@@ -125,6 +327,25 @@ class CdiDirectory:
 			
 			self.fileDescriptors.append(file)
 
+# The file attribute flag bits, in the order they're listed.
+_ATTRIBUTE_BITS = (
+	(0x0001, "Owner Read"),
+	(0x0004, "Owner Execute"),
+	(0x0010, "Group Read"),
+	(0x0040, "Group Execute"),
+	(0x0100, "World Read"),
+	(0x0400, "World Execute"),
+	(0x4000, "CD-DA file"),
+	(0x8000, "Directory"),
+)
+
+# The fixed-size fields of a directory record, read in one go: record length, extended attribute length,
+# start block, size, creation date, flags, interleave ratio, sequence number, and name length.
+_FILE_RECORD_PREFIX = "BB4xI4xI6sxBBB2xHB"
+
+# The fixed-size fields after the name: owner group, owner user, attributes, and file number.
+_FILE_RECORD_SUFFIX = "HHH2xBx"
+
 class CdiFile:
 	def __init__(self, stream: StructStream):
 		s = stream
@@ -132,24 +353,10 @@ class CdiFile:
 		
 		self._cachedBytes: Optional[bytes] = None
 		
-		recordLength: int = s.take("B")
-		self.exAttribs: int = s.take("B")
-		self.startBlock: int = s.skip(4).take("I")
-		self.size: int = s.skip(4).take("I")
-		creationDateRaw: List[int] = list(s.take("6B"))
-		self.creationDate = datetime.datetime(
-			creationDateRaw[0] + 1900,
-			creationDateRaw[1],
-			creationDateRaw[2],
-			hour=creationDateRaw[3],
-			minute=creationDateRaw[4],
-			second=creationDateRaw[5]
-		)
-		flags: int = s.skip(1).take("B")
+		(recordLength, self.exAttribs, self.startBlock, self.size, self.creationDateRaw, flags,
+			interleave0, interleave1, self.sequenceNumber, nameLength) = s.take(_FILE_RECORD_PREFIX)
 		self.isHidden = flags & 1 != 0
-		self.interleaveRatio: List[int] = list(s.take("BB"))
-		self.sequenceNumber: int = s.skip(2).take("H")
-		nameLength: int = s.take("B")
+		self.interleaveRatio: List[int] = [interleave0, interleave1]
 		rawName = s.takeRaw(nameLength)
 		if rawName == b'\x00':
 			self.name = "<PhloNickname:ROOT>"
@@ -161,33 +368,14 @@ class CdiFile:
 		if nameLength % 2 == 0:
 			s.skip(1)
 		
-		ownerGroup, ownerUser = s.take("HH")
+		ownerGroup, ownerUser, attributeFlags, self.fileNumber = s.take(_FILE_RECORD_SUFFIX)
 		self.owner = {"group": ownerGroup, "user": ownerUser}
-		attributeFlags: int = s.take("H")
-		self.fileNumber: int = s.skip(2).take("B")
-		s.skip(1)
 		
 		self.attributes: List[Literal[
 			"Owner Read", "Owner Execute", "Group Read",
 			"Group Execute", "World Read", "World Execute",
 			"CD-DA file", "Directory"
-				]] = []
-		if attributeFlags & 0x0001 != 0:
-			self.attributes.append("Owner Read")
-		if attributeFlags & 0x0004 != 0:
-			self.attributes.append("Owner Execute")
-		if attributeFlags & 0x0010 != 0:
-			self.attributes.append("Group Read")
-		if attributeFlags & 0x0040 != 0:
-			self.attributes.append("Group Execute")
-		if attributeFlags & 0x0100 != 0:
-			self.attributes.append("World Read")
-		if attributeFlags & 0x0400 != 0:
-			self.attributes.append("World Execute")
-		if attributeFlags & 0x4000 != 0:
-			self.attributes.append("CD-DA file")
-		if attributeFlags & 0x8000 != 0:
-			self.attributes.append("Directory")
+				]] = [name for bit, name in _ATTRIBUTE_BITS if attributeFlags & bit != 0]
 			
 		self.sectors: List[CdiSector] = []
 		self.blocks: List[bytes] = []
@@ -202,6 +390,18 @@ class CdiFile:
 		
 		assert mark - len(s) == recordLength, (len(s), mark, recordLength, self.__dict__)
 	
+	@property
+	def creationDate(self) -> datetime.datetime:
+		"""Parsed on demand, since most callers never look at it."""
+		return datetime.datetime(
+			self.creationDateRaw[0] + 1900,
+			self.creationDateRaw[1],
+			self.creationDateRaw[2],
+			hour=self.creationDateRaw[3],
+			minute=self.creationDateRaw[4],
+			second=self.creationDateRaw[5]
+		)
+	
 	def getBytes(self) -> bytes:
 		if self._cachedBytes == None:
 			self._cachedBytes = b''.join(self.blocks)
@@ -241,7 +441,7 @@ class CdiFileSystem:
 		for file in tqdm(self.rootDir.fileDescriptors, desc="building files"):
 			self.files[file.name] = file
 			file.sectors = self.sectors[file.startBlock:file.startBlock + math.ceil(file.size / self.volume.blockSize)]
-			file.blocks = [s.data for s in file.sectors]
+			file.blocks = file.sectors.payloads()
 			if file.size % self.volume.blockSize != 0:
 				file.blocks[-1] = file.blocks[-1][:file.size % self.volume.blockSize]
 		
@@ -270,116 +470,71 @@ class CdiFileSystem:
 		
 		`file` is a `bytes` object.
 		"""
-		offset, strlen = struct.unpack("QQ", fileBytes[:16])
-		blob = fileBytes[offset:]
+		offset, strlen = _DISK_HEADER.unpack_from(fileBytes, 0)
+		# A view, so the raw data isn't copied out of the file.
+		blob = memoryview(fileBytes)[offset:]
 		with tqdm(total = 1, desc = "parsing file") as t:
 			metadata = json.loads(fileBytes[16:16 + strlen].decode('utf-8'))
 			t.update(1)
 		
-		# Parse all the sectors.
-		self.sectors: List[CdiSector] = []
-		for sector in tqdm(metadata["sectors"], desc = "building sectors"):
-			rawData = blob[sector["dataOffset"]:sector["dataOffset"] + sector["dataLength"]]
-			self.sectors.append(CdiSector(sector, rawData))
+		# Parse all the sectors. `CdiSector` objects are only built for the sectors that get used.
+		self.sectors = CdiSectorList(metadata["sectors"], blob)
 	
 	def _identifyModules(self):
 		self.modules = {}
 		
 		duplicateNames: List[str] = []
 		
-		for f in tqdm(self.files, desc = "searching files for modules"):
-			if not f[:4] == "cdi_":
-				continue
-			blocks = self.files[f].blocks
-			assert blocks[0][:2] == b'\x4A\xFC', blocks[0][:2]
+		# Only the cdi_ files hold modules.
+		candidates = [f for f in self.files if f.startswith("cdi_")]
+		for f in tqdm(candidates, desc = "searching files for modules"):
+			data = self.files[f].getBytes()
+			assert data.startswith(b'\x4A\xFC'), data[:2]
 			
-			with tqdm(total = len(blocks), desc = "searching " + f + " for modules") as t:
-				currentBlockIndex = 0
-				currentOffset = 0
-				#print("There are", len(blocks), "blocks")
-				while currentBlockIndex < len(blocks):
-					#print("block", currentBlockIndex, "offset", currentOffset)
-					currentBlock = blocks[currentBlockIndex]
+			# Scan the whole file as one buffer. Slices of the memoryview don't copy.
+			buf = memoryview(data)
+			with tqdm(total = len(buf), desc = "searching " + f + " for modules") as t:
+				cursor = 0
+				unusedBytes = []
+				while cursor < len(buf):
+					#print("offset", cursor)
 					
-					# Look for the next sync bytes
-					foundModule = currentBlock[currentOffset:currentOffset + 2] == b'\x4A\xFC'
+					# Find the next sync bytes that start a real header.
+					start = data.find(b'\x4A\xFC', cursor)
+					while start >= 0 and not _isModuleHeader(buf, start):
+						start = data.find(b'\x4A\xFC', start + 1)
 					
-					# If no sync bytes, stop searching
-					if not foundModule:
-						unusedBytes = [currentBlock[currentOffset:]]
-						total = len(unusedBytes[-1])
-						currentBlockIndex += 1
-						t.update(1)
-						while currentBlockIndex < len(blocks):
-							unusedBytes.append(blocks[currentBlockIndex])
-							total += len(unusedBytes[-1])
-							currentBlockIndex += 1
-							t.update(1)
-						#print("Unused byte count:", total)
-						self.files[f].unusedBytes = unusedBytes
+					# If no more modules, stop searching
+					if start < 0:
+						#print("Unused byte count:", len(buf) - cursor)
+						unusedBytes.append(buf[cursor:])
+						t.update(len(buf) - cursor)
 						break
 					
-					# Make sure the whole header is in the same byte string
-					if currentBlockIndex + 1 < len(blocks):
-						dualBlock = currentBlock + blocks[currentBlockIndex + 1]
+					if start > cursor:
+						#print("Skipped", start - cursor, "bytes")
+						unusedBytes.append(buf[cursor:start])
+						t.update(start - cursor)
+						cursor = start
 					
-					# +4 is file size
-					moduleSize = struct.unpack(">I", dualBlock[currentOffset + 4:currentOffset + 8])[0]
+					# +4 is file size, +12 is name pointer
+					moduleSize, moduleNamePointer = _MODULE_HEADER.unpack_from(buf, cursor)
 					#print("size:", hex(moduleSize))
 					
-					# +12 is name pointer
-					moduleNamePointer = struct.unpack(">I", dualBlock[currentOffset + 12:currentOffset + 16])[0]
 					if moduleNamePointer >= moduleSize:
 						break
 					
-					# Gather module bytes
-					currentModule = []
-					currentBlock = currentBlock[currentOffset:]
-					while len(currentBlock) < moduleSize and currentBlockIndex < len(blocks):
-						currentModule.append(currentBlock)
-						moduleSize -= len(currentBlock)
-						currentOffset = 0
-						currentBlockIndex += 1
-						t.update(1)
-						if currentBlockIndex < len(blocks):
-							currentBlock = blocks[currentBlockIndex]
-						else:
-							raise Exception("Ran out of blocks to add: " + str(currentBlockIndex))
-					
-					currentOffset += moduleSize
-					currentModule.append(currentBlock[:currentOffset])
-					#print("Module is", len(currentModule), "blocks")
-					#print("Name pointer is", moduleNamePointer)
+					if cursor + moduleSize > len(buf):
+						raise Exception("Ran out of bytes to add: " + str(cursor + moduleSize - len(buf)))
 					
+					currentModule = [buf[cursor:cursor + moduleSize]]
 					
 					# Get the module name string
-					name = None
-					takeNameFromStartOfBlock = False
-					for i, block in enumerate(currentModule):
-						#print("Searching block", i, "for name")
-						#print("Block length", len(block), "name ptr", moduleNamePointer)
-						if name == None:
-							if len(block) > moduleNamePointer:
-								#print("Name starts within this block")
-								nameEnd = block.index(0, moduleNamePointer)
-								if nameEnd < 0:
-									#print("Name crosses block boundary")
-									name = block[moduleNamePointer:]
-									moduleNamePointer -= len(name)
-									takeNameFromStartOfBlock = True
-								else:
-									name = block[moduleNamePointer:nameEnd]
-							else:
-								moduleNamePointer -= len(block)
-						elif takeNameFromStartOfBlock:
-							nameEnd = block.index(0)
-							assert nameEnd >= 0
-							name += block[:nameEnd]
-							takeNameFromStartOfBlock = False
-						else:
-							break
-					assert name != None
-					assert not takeNameFromStartOfBlock
+					nameStart = cursor + moduleNamePointer
+					name = data[nameStart:data.index(0, nameStart)]
+					
+					cursor += moduleSize
+					t.update(moduleSize)
 					
 					#name = name.decode('ascii')
 					
@@ -397,6 +552,9 @@ class CdiFileSystem:
 						fullName = name
 					
 					self.modules[fullName] = {"blocks": currentModule, "name": name, "parentFile": f}
+				
+				if len(unusedBytes) != 0:
+					self.files[f].unusedBytes = unusedBytes
 
 def loadCdiImageFile(filename: str) -> CdiFileSystem:
 	with open(filename, "rb") as f:
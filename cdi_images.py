@@ -1,82 +1,78 @@
 import PIL.Image
-import array
+import itertools
+import operator
+import re
 from struct_stream import StructStream
-import struct
 
-QUANT_TABLE = [
+QUANT_TABLE = (
           0,   1,   4,   9,
          16,  27,  44,  79,
         128, 177, 212, 229,
         240, 247, 252, 255
-    ]
+    )
+
+# Translate tables from a DYUV byte to the quantized delta for its low or high nibble.
+_DELTA_LO = bytes(QUANT_TABLE[b & 0x0F] for b in range(256))
+_DELTA_HI = bytes(QUANT_TABLE[(b & 0xF0) >> 4] for b in range(256))
+
+def _accumulate_deltas(deltas, start):
+    "Running sums of `deltas` starting from `start`, wrapped to a byte."
+    sums = itertools.accumulate(deltas, initial=start)
+    next(sums)
+    return bytes(map((0xFF).__and__, sums))
 
 def to_yuv422p(data, width, height, startValues):
     
     # Adapted from https://github.com/roysmeding/cditools/blob/rewrite/cdi/formats/dyuv.py#L28
-    Y = array.array('B', (0 for _ in range(width * height     )))
-    U = array.array('B', (0 for _ in range(width * height // 2)))
-    V = array.array('B', (0 for _ in range(width * height // 2)))
-
-    for y in range(height):
-        if isinstance(startValues, list) and isinstance(startValues[0], tuple):
-            Yprev, Uprev, Vprev = startValues[y]
-        else:
-            Yprev, Uprev, Vprev = startValues
-
-        for x in range(0, width, 2):
-            idx = y * width + x
-            B0, B1 = struct.unpack('BB', data[idx:idx + 2])
-
-            dU, dY0 = (B0 & 0xF0) >> 4, B0 & 0x0F
-            dV, dY1 = (B1 & 0xF0) >> 4, B1 & 0x0F
-
-            Yprev = (Yprev + QUANT_TABLE[dY0]) & 0xFF
-            Y[idx] = Yprev
-
-            Yprev = (Yprev + QUANT_TABLE[dY1]) & 0xFF
-            Y[idx + 1] = Yprev
-
-            Uprev = (Uprev + QUANT_TABLE[dU ]) & 0xFF
-            U[idx // 2] = Uprev
-
-            Vprev = (Vprev + QUANT_TABLE[dV ]) & 0xFF
-            V[idx // 2] = Vprev
+    Y = bytearray(width * height)
+    U = bytearray(width * height // 2)
+    V = bytearray(width * height // 2)
+
+    # startValues is either one (Y, U, V) tuple for every row, or a list with one per row.
+    if not (isinstance(startValues, list) and isinstance(startValues[0], tuple)):
+        startValues = itertools.repeat(startValues, height)
+    elif len(startValues) < height:
+        raise ValueError("Not enough DYUV start values: {} for {} rows".format(len(startValues), height))
+
+    for y, (Yprev, Uprev, Vprev) in zip(range(height), startValues):
+        # Every byte holds a Y delta in its low nibble. Even bytes hold a U
+        # delta in the high nibble, odd bytes a V delta.
+        idx = y * width
+        row = bytes(data[idx:idx + width])
+        if len(row) != width:
+            raise ValueError("Not enough DYUV data")
+        Y[idx:idx + width] = _accumulate_deltas(row.translate(_DELTA_LO), Yprev)
+        U[idx // 2:(idx + width) // 2] = _accumulate_deltas(row[0::2].translate(_DELTA_HI), Uprev)
+        V[idx // 2:(idx + width) // 2] = _accumulate_deltas(row[1::2].translate(_DELTA_HI), Vprev)
     return Y, U, V
 
 def to_yuv444p(data, width, height, startValues):
     Y, U, V = to_yuv422p(data, width, height, startValues)
 
-    Uout = array.array('B', (0 for _ in range(width * height)))
-    Vout = array.array('B', (0 for _ in range(width * height)))
+    return Y, _upsample_chroma(U, width, height), _upsample_chroma(V, width, height)
 
+def _upsample_chroma(plane, width, height):
+    """
+    Doubles the width of a 4:2:2 chroma plane. Each new sample is the average of its neighbours, except at the
+    end of a row, where the last sample is repeated.
+    """
+    out = bytearray(width * height)
+    half = width // 2
     for y in range(height):
-        for x in range(0, width, 2):
-            idx = y * width + x
-
-            Uout[idx] = U[idx // 2]
-            if x < width - 2:
-                Uout[idx + 1] = (U[idx // 2] + U[(idx // 2) + 1]) // 2
-            else:
-                Uout[idx + 1] =  U[idx // 2]
-
-            Vout[idx] = V[idx // 2]
-            if x < width - 2:
-                Vout[idx + 1] = (V[idx // 2] + V[(idx // 2) + 1]) // 2
-            else:
-                Vout[idx + 1] =  V[idx // 2]
-
-    return Y, Uout, Vout
+        row = plane[y * half:(y + 1) * half]
+        if len(row) == 0:
+            continue
+        averages = bytearray(map(operator.rshift, map(operator.add, row, row[1:]), itertools.repeat(1)))
+        averages.append(row[-1])
+        out[y * width:(y + 1) * width:2] = row
+        out[y * width + 1:(y + 1) * width:2] = averages
+    return out
     
 def dyuvToRGB(data, width, height, startValues):
     Y, U, V = to_yuv444p(data, width, height, startValues)
-    # def to_pil(self):
-    def _interleave():
-        for i in range(len(Y)):
-            yield Y[i]
-            yield U[i]
-            yield V[i]
-
-    return PIL.Image.frombytes('YCbCr', (width, height), bytes(_interleave())).convert('RGB')
+    # PIL interleaves the three planes itself.
+    bands = [PIL.Image.frombytes('L', (width, height), bytes(plane)) for plane in (Y, U, V)]
+    return PIL.Image.merge('YCbCr', bands).convert('RGB')
 
 # Sane defaults
 def dyuvToRGBBackground(data):
@@ -87,48 +83,74 @@ def clut8ToRGB(data, width, height, palette):
     image.putpalette(palette)
     return image
 
+# Translate table that clears the high bit of every byte.
+_STRIP_HI = bytes(b & 0x7F for b in range(256))
+
+# The last alternative catches a run pixel cut off before its repeat count.
+_RL7_TOKEN = re.compile(rb'([\x00-\x7F]+)|([\x80-\xFF])(.)|([\x80-\xFF])\Z', re.DOTALL)
+
+def _rgbToRgbaPalette(palette: bytes, transparentColor = None) -> bytes:
+    """Adds an alpha byte to every RGB entry: 0 for entries equal to `transparentColor`, otherwise 0xFF."""
+    count = len(palette) // 3
+    rgbaPalette = bytearray(b'\xFF' * (count * 4))
+    for channel in range(3):
+        rgbaPalette[channel::4] = palette[channel:count * 3:3]
+
+    # Any bytes-like color (bytearray, memoryview) compares the same as bytes.
+    if transparentColor != None:
+        transparentColor = bytes(transparentColor)
+
+    if transparentColor != None and len(transparentColor) == 3:
+        # `find` can match across two entries, so only matches starting at a
+        # multiple of 3 count.
+        i = palette.find(transparentColor)
+        while 0 <= i < count * 3:
+            if i % 3 == 0:
+                rgbaPalette[i // 3 * 4 + 3] = 0
+            i = palette.find(transparentColor, i + 1)
+
+    # A trailing partial entry is kept as-is, like the full ones.
+    if len(palette) % 3 != 0:
+        rest = palette[count * 3:]
+        rgbaPalette += rest + (b'\0' if rest == transparentColor else b'\xFF')
+    return bytes(rgbaPalette)
+
 def rl7ToRGB(data, palette:bytes, transparentColor = None, emptySpaceColorIndex = 0, forceWidth = None):
     assert isinstance(palette, bytes)
-    lastNonzeroIndex = 0
-    for i, b in enumerate(data):
-        if b != 0:
-            lastNonzeroIndex = i
+    # An all-zero image counts as ending at index 0.
+    lastNonzeroIndex = max(0, len(bytes(data).rstrip(b'\0')) - 1)
     #print(lastNonzeroIndex, len(data))
     truncImageData = data[:lastNonzeroIndex + 2]
 
-    i = 0
+    # Each token is a run of literal pixels (high bit clear), or a high-bit pixel followed by a repeat
+    # count. A repeat count of 0 ends the row.
     pixelRows = []
-    currentRow = b''
-    while i < len(truncImageData):
-        if truncImageData[i] & 0x80 == 0:
-            #print("single")
-            currentRow += truncImageData[i].to_bytes(1)
-            i += 1
-        elif truncImageData[i + 1] == 0:
+    currentRow = bytearray()
+    for literal, repeated, count, truncated in _RL7_TOKEN.findall(truncImageData):
+        if literal:
+            currentRow.extend(literal)
+        elif truncated:
+            print("Warning: data ended in a run pixel with no repeat count")
+        elif count == b'\0':
             pixelRows.append(currentRow)
-            currentRow = b''
-            i += 2
+            currentRow = bytearray()
         else:
-            c = (truncImageData[i] & 0x7F).to_bytes(1)
-            for _ in range(truncImageData[i + 1]):
-                currentRow += c
-            i += 2
+            currentRow.extend(repeated.translate(_STRIP_HI) * count[0])
     if len(currentRow) != 0:
         print("Warning: last row had data")
         pixelRows.append(currentRow)
     del currentRow
-    del i
 
     if forceWidth == None:
         width = max([len(r) for r in pixelRows])
     else:
         width = forceWidth
     height = len(pixelRows)
-    pixels = b''
+    pixels = bytearray()
+    padding = bytes([emptySpaceColorIndex])
     for row in pixelRows:
-        pixels += row 
-        for _ in range(width - len(row)):
-            pixels += emptySpaceColorIndex.to_bytes(1)
+        pixels.extend(row)
+        pixels.extend(padding * (width - len(row)))
     assert len(pixels) == width * height
 
     if len(pixels) == 0:
@@ -137,18 +159,9 @@ def rl7ToRGB(data, palette:bytes, transparentColor = None, emptySpaceColorIndex
         ret.putpalette(b'\0\0\0\0', rawmode = "RGBA")
         return ret
 
-    img = PIL.Image.frombytes('P', (width, height), pixels)
+    img = PIL.Image.frombytes('P', (width, height), bytes(pixels))
 
     
-    rgbaPalette = b''
-    i = 0
-    while i < len(palette):
-        c = palette[i:i + 3]
-        rgbaPalette += c
-        if c == transparentColor:
-            rgbaPalette += b'\0'
-        else:
-            rgbaPalette += 0xFF.to_bytes(1)
-        i += 3
+    rgbaPalette = _rgbToRgbaPalette(palette, transparentColor)
     img.putpalette(rgbaPalette, rawmode="RGBA")
     return img
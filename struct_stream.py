@@ -2,6 +2,12 @@
 from typing import Self
 import struct
 
+# Compiled formats used by `StructStream.peek`, keyed by the format string (including any endian prefix).
+_STRUCT_CACHE = {}
+
+# A single unsigned 32-bit int, for each endian prefix. Used by `StructStream.peekU32`.
+_U32 = {prefix: struct.Struct((prefix or "") + "I") for prefix in (None, "@", "=", "<", ">", "!")}
+
 class StructStream:
 	def __init__(self, data, cursor = 0, endianPrefix = None, simpleReturn = True):
 		"""
@@ -9,27 +15,47 @@ class StructStream:
 		"""
 		assert isinstance(data, bytes)
 		self._data = data
+		# The stream is the window `_data[_start:_end]`. The cursor is relative to `_start`.
+		self._start = 0
+		self._end = len(data)
 		self._cursor = cursor
 		self._prefix = endianPrefix
 		self._simplify = simpleReturn
 		
 		self._peekAmount = 0
 	
+	# Static
+	def fromSlice(data, offset, length, endianPrefix = None, simpleReturn = True) -> "StructStream":
+		"""
+		A stream over `data[offset:offset + length]` that shares `data` instead of copying the slice. The window
+		is clamped to the end of `data`.
+		"""
+		ret = StructStream(data, endianPrefix=endianPrefix, simpleReturn=simpleReturn)
+		ret._start = min(offset, len(data))
+		ret._end = max(ret._start, min(offset + length, len(data)))
+		return ret
+	
+	def _window(self, offset, length) -> Self:
+		"""A stream over `length` bytes of this one's window, starting at `offset` from its start."""
+		start = min(self._start + offset, self._end)
+		return StructStream.fromSlice(self._data, start, min(length, self._end - start),
+			endianPrefix=self._prefix, simpleReturn=self._simplify)
+	
 	###############
 	# Built-ins
 	
 	def __len__(self):
 		"""The remaining bytes in the stream."""
-		return max(0, len(self._data) - self._cursor)
+		return max(0, self._end - self._start - self._cursor)
 
 	def __str__(self):
-		return str(self._data[self._cursor:])
+		return str(self._data[self._start + self._cursor:self._end])
 	
 	def __repr__(self):
 		ret = "StructStream(" + repr(self.peekRaw(30))
 		if len(self) > 30:
 			ret += "..."
-		ret += ", cursor=" + str(min(self._cursor, len(self._data)))
+		ret += ", cursor=" + str(min(self._cursor, self._end - self._start))
 		if self._prefix:
 			ret += ", endianPrefix=" + self._prefix
 		return ret + ")"
@@ -38,7 +64,8 @@ class StructStream:
 	# Raw byte functions
 	
 	def peekRaw(self, count, fillZeros = False) -> bytes:
-		ret = self._data[self._cursor:self._cursor + count]
+		start = self._start + self._cursor
+		ret = self._data[start:min(start + count, self._end)]
 		if fillZeros and len(ret) < count:
 			ret += b'0' * (count - len(ret))
 		self._peekAmount = count
@@ -63,7 +90,15 @@ class StructStream:
 			return ()
 		if self._prefix and formatStr[0] not in "@=<>!":
 			formatStr = self._prefix + formatStr
-		retTuple = struct.unpack(formatStr, self.peekRaw(struct.calcsize(formatStr), fillZeros))
+		compiled = _STRUCT_CACHE.get(formatStr)
+		if compiled == None:
+			compiled = _STRUCT_CACHE[formatStr] = struct.Struct(formatStr)
+		if self._cursor + compiled.size > self._end - self._start:
+			# Runs past the end of the window. Either pad it, or let struct raise the error.
+			retTuple = compiled.unpack(self.peekRaw(compiled.size, fillZeros))
+		else:
+			retTuple = compiled.unpack_from(self._data, self._start + self._cursor)
+			self._peekAmount = compiled.size
 		if self._simplify and len(retTuple) == 1:
 			return retTuple[0]
 		else:
@@ -74,16 +109,39 @@ class StructStream:
 		self._cursor += self._peekAmount
 		return ret
 	
+	def peekU32(self) -> int:
+		"""The same as `peek("I")`, without the format lookup. Uses the stream's endian prefix."""
+		if self._cursor + 4 > self._end - self._start:
+			return self.peek("I")
+		self._peekAmount = 4
+		return _U32[self._prefix or None].unpack_from(self._data, self._start + self._cursor)[0]
+	
+	def peekArray(self, count, formatChar, fillZeros = False) -> tuple:
+		"""Peeks `count` values of the same type. Always returns a tuple, even for 0 or 1 values."""
+		if count == 0:
+			self._peekAmount = 0
+			return ()
+		ret = self.peek(str(count) + formatChar, fillZeros)
+		if count == 1 and self._simplify:
+			return (ret,)
+		return ret
+	
+	def takeArray(self, count, formatChar, fillZeros = False) -> tuple:
+		ret = self.peekArray(count, formatChar, fillZeros)
+		self._cursor += self._peekAmount
+		return ret
+	
 	def peekNullTermString(self, includeTerminator = False) -> bytes:
 		self._cursor = max(self._cursor, 0)
 		try:
-			ret = self.peekRaw(self._data.index(0, self._cursor) - self._cursor + 1)
+			start = self._start + self._cursor
+			ret = self.peekRaw(self._data.index(0, start, self._end) - start + 1)
 			if includeTerminator:
 				return ret
 			else:
 				return ret[:-1]
 		except ValueError:
-			ret = self._data[self._cursor:]
+			ret = self._data[self._start + self._cursor:self._end]
 			self._peekAmount = len(ret)
 			return ret
 	
@@ -103,12 +161,27 @@ class StructStream:
 		self._cursor = max(0, offset)
 		return self
 	
+	def tell(self) -> int:
+		"""The cursor position, relative to the start of the stream."""
+		return self._cursor
+	
 	def copy(self) -> Self:
 		"""
 		Performs a shallow copy, a second view into the same data stream. INCLUDES data from before the current
 		cursor position.
 		"""
-		return StructStream(self._data, cursor=self._cursor, endianPrefix=self._prefix, simpleReturn=self._simplify)
+		ret = self._window(0, self._end - self._start)
+		ret._cursor = self._cursor
+		return ret
+	
+	def viewAt(self, offset) -> Self:
+		"""
+		The same as `copy().skip(offset)`: a second view into the same data stream, INCLUDING data from before
+		the cursor, with its cursor moved `offset` bytes past this one's.
+		"""
+		ret = self._window(0, self._end - self._start)
+		ret._cursor = max(0, self._cursor + offset)
+		return ret
 	
 	def fork(self, skip = 0) -> Self:
 		"""
@@ -117,17 +190,31 @@ class StructStream:
 
 		Optionally skips `skip` bytes before taking the fork, without modifying this stream.
 		"""
-		return StructStream(self._data[self._cursor + skip:], endianPrefix=self._prefix, simpleReturn=self._simplify)
+		return self._window(max(0, self._cursor + skip), self._end - self._start)
+	
+	def forkAt(self, offset, length = None) -> Self:
+		"""
+		A stream over `length` bytes (or the rest of the data) starting at `offset` from the start of this stream,
+		regardless of the cursor. Doesn't modify this stream.
+		"""
+		if length == None:
+			length = self._end - self._start
+		return self._window(max(0, offset), length)
 	
 	def peekFork(self, count, fillZeros = False) -> Self:
 		"""Performs a peekRaw, and then constructs a new stream out of the data."""
-		data = self.peekRaw(count, fillZeros)
-		return StructStream(data, endianPrefix=self._prefix, simpleReturn=self._simplify)
+		if fillZeros and count > len(self):
+			# The padding has to live somewhere, so this one copies.
+			data = self.peekRaw(count, fillZeros)
+			return StructStream(data, endianPrefix=self._prefix, simpleReturn=self._simplify)
+		self._peekAmount = count
+		return self._window(self._cursor, count)
 	
 	def takeFork(self, count, fillZeros = False) -> Self:
 		"""Performs a peekRaw, and then constructs a new stream out of the data."""
-		data = self.takeRaw(count, fillZeros)
-		return StructStream(data, endianPrefix=self._prefix, simpleReturn=self._simplify)
+		ret = self.peekFork(count, fillZeros)
+		self._cursor += count
+		return ret
 
 
 def testStructStream():
@@ -144,4 +231,54 @@ def testStructStream():
 	assert t == b''
 	del t
 	del test
+
+	# Nested windows, clamped to the enclosing window and to the buffer end
+	test = StructStream(b'0123456789abcdef', endianPrefix = ">")
+	outer = test.forkAt(2, 10)
+	assert outer.peekRaw(99) == b'23456789ab'
+	assert len(outer) == 10
+	inner = outer.forkAt(3, 4)
+	assert inner.peekRaw(99) == b'5678'
+	assert repr(inner) == "StructStream(b'5678', cursor=0, endianPrefix=>)", repr(inner)
+	assert outer.forkAt(8, 10).peekRaw(99) == b'ab'
+	assert len(test.forkAt(20, 4)) == 0
+	end = StructStream(b'0123456789abcdef')
+	end.seek(14)
+	assert end.peekFork(10).peekRaw(99) == b'ef'
+	assert end.tell() == 14
+	del outer, inner, end
+
+	# len() and repr() on forks, including past the end
+	f = test.fork(4)
+	assert len(f) == 12
+	assert repr(f) == "StructStream(b'456789abcdef', cursor=0, endianPrefix=>)", repr(f)
+	f.skip(20)
+	assert len(f) == 0
+	assert repr(f) == "StructStream(b'', cursor=12, endianPrefix=>)", repr(f)
+	del f
+
+	# Forks, copies and views keep their own cursors
+	parent = StructStream(b'0123456789abcdef')
+	child = parent.takeFork(4)
+	assert parent.tell() == 4
+	assert child.peekRaw(9) == b'0123'
+	child.take("B")
+	assert parent.tell() == 4 and child.tell() == 1
+	copy = parent.copy()
+	copy.skip(2)
+	assert parent.tell() == 4 and copy.tell() == 6
+	view = parent.viewAt(2)
+	assert view.tell() == 6
+	assert view.peekRaw(3) == b'678'
+	assert parent.tell() == 4
+	del parent, child, copy, view
+
+	# peekU32 and arrays
+	assert test.peekU32() == 0x30313233
+	assert StructStream(b'\x01\x02\x03\x04', endianPrefix = "").peekU32() == 0x04030201
+	assert test.peekArray(0, "B") == ()
+	assert test.peekArray(1, "B") == (0x30,)
+	assert test.takeArray(2, "H") == (0x3031, 0x3233)
+	assert test.tell() == 4
+	del test
 	print("All tests passed")
\ No newline at end of file
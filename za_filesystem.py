@@ -1,5 +1,9 @@
 
-from typing import Self, Dict, List, Literal, TYPE_CHECKING, Optional, Union
+import collections.abc
+import itertools
+import operator
+import sys
+from typing import Self, Dict, List, Literal, TYPE_CHECKING, Optional, Sequence, Tuple, Union
 
 from struct_stream import StructStream
 if TYPE_CHECKING:
@@ -27,6 +31,9 @@ class ResourceTree:
     # particular.
     size: int
 
+    # Trees have thousands of nodes, so they don't get a `__dict__`.
+    __slots__ = ("tag", "size")
+
     def __init__(self, stream: StructStream):
         self.tag, self.size = stream.take("II")
     
@@ -40,25 +47,33 @@ class ResourceTree:
         If the tag is not recognized, it returns the base class.
         """
         
-        tag = stream.peek("I")
-        if tag == 0:
-            return ResourceTreeNode(stream)
-        elif tag == 1:
-            return ResourceTreeArray(stream)
-        elif tag == 2:
-            return ResourceTreeSet(stream)
-        else:
+        tag = stream.peekU32()
+        nodeClass = _NODE_CLASSES.get(tag)
+        if nodeClass == None:
             print("Unknown tag type:", tag)
             return ResourceTree(stream)
+        return nodeClass(stream)
     
-    def simplify(self) -> Union[dict, list]:
+    def simplify(self) -> Union[dict, Sequence[StructStream]]:
         """
-        Convert this node and all its children into json-serializable types.
+        Convert this node and all its children into plain types. Nodes become
+        dicts. Sets and Arrays become their `elements`: a read-only sequence of
+        StructStreams built on first access, not a list.
         """
 
         # Abstract method
         raise NotImplementedError()
 
+# Decoded names, keyed by their raw bytes. The same few names repeat all over
+# a filesystem, so each one is only decoded (and interned) once.
+_NAMES: Dict[bytes, str] = {}
+
+def _decodeName(raw: bytes) -> str:
+    name = _NAMES.get(raw)
+    if name == None:
+        name = _NAMES[raw] = sys.intern(raw.decode('ascii'))
+    return name
+
 class ResourceTreeNode(ResourceTree):
     """
     The Tree part of the Resource Tree. It's named poorly.
@@ -83,22 +98,36 @@ class ResourceTreeNode(ResourceTree):
     # all strings. They're almost alway strings.
     children: Union[Dict[int, ResourceTree], Dict[str, ResourceTree]]
 
+    __slots__ = ("hasNames", "children")
+
     def __init__(self, stream: StructStream):
-        originalStream = stream.copy()
-        ResourceTree.__init__(self, stream)
+        # Nested nodes are parsed with an explicit stack instead of recursing
+        # through `parseFromStream`, so deep trees don't need a deep Python stack.
+        stack = [(self, stream)]
+        while stack:
+            node, nodeStream = stack.pop()
+            stack.extend(reversed(node._parse(nodeStream)))
+    
+    def _parse(self, stream: StructStream) -> List[Tuple["ResourceTreeNode", StructStream]]:
+        """
+        Parse this node. Children that are nodes themselves are created but not
+        parsed yet; they're returned along with their streams.
+        """
+        start = stream.tell()
+        # The common header and this node's fields are read together.
+        self.tag, self.size, childCount, nameListNodeOffset, childListNodeOffset = stream.take("IIIII")
         assert self.tag == 0, self.tag
         
-        originalStream = originalStream.takeFork(self.size)
+        originalStream = stream.forkAt(start, self.size)
         
         # The two main parts of the node are the list of names and the list of
         # children data streams. childCount CAN be used for parsing these lists,
         # but the name list is a full ResourceTreeSet with its own length value,
         # so it wasn't necessary.
-        childCount, nameListNodeOffset, childListNodeOffset = stream.take("III")
         #print("root", childCount, nameListNodeOffset, childListNodeOffset)
         
-        nameListStream = originalStream.copy().skip(nameListNodeOffset)
-        childListStream = originalStream.copy().skip(childListNodeOffset)
+        nameListStream = originalStream.viewAt(nameListNodeOffset)
+        childListStream = originalStream.viewAt(childListNodeOffset)
         
         # I honestly don't know if this is necessary anymore. It used to be
         # important for the `stream` to be correctly sized (to find hidden/
@@ -111,30 +140,46 @@ class ResourceTreeNode(ResourceTree):
         # Parse the child list first, since it's always present.
         childListNode = ResourceTreeSet(childListStream)
 
-        # Parse all of the children recursively.
-        children = [ResourceTree.parseFromStream(s) for s in childListNode.elements]
+        # Parse all of the children, except for nested nodes.
+        children = []
+        nested = []
+        for s in childListNode.elements:
+            if s.peekU32() == 0:
+                child = ResourceTreeNode.__new__(ResourceTreeNode)
+                nested.append((child, s))
+            else:
+                child = ResourceTree.parseFromStream(s)
+            children.append(child)
         
         # Check if there is a name list.
         if nameListNodeOffset == 0:
             # No, use numbers.
-            names = list(range(len(children)))
+            self.children: Dict[int, ResourceTree] = dict(enumerate(children))
             self.hasNames = False
         else:
             # Yes, parse the list then decode the data as null-terminated ascii strings.
             nameListNode = ResourceTreeSet(nameListStream)
-            names = [s.copy().takeNullTermString().decode('ascii') for s in nameListNode.elements]
+            # Peeking leaves the element stream alone, so it doesn't need a copy.
+            names = [_decodeName(s.peekNullTermString()) for s in nameListNode.elements]
+            # Combine the name list and child list into a single dict.
+            self.children: Dict[str, ResourceTree] = dict(zip(names, children))
             self.hasNames = True
         
-        # Combine the name list and child list into a single dict. Could probably do
-        # something fancy with `zip()` and iterators. Whatever.
-        self.children: Dict[str, ResourceTree] = {}
-        for i in range(len(names)):
-            self.children[names[i]] = children[i]
+        return nested
     
     def simplify(self) -> dict:
+        # Walk the tree with an explicit stack instead of recursing. Each dict
+        # is created (in key order) before its node's children are filled in.
         ret = {}
-        for name, child in self.children.items():
-            ret[name] = child.simplify()
+        stack = [(self, ret)]
+        while stack:
+            node, out = stack.pop()
+            for name, child in node.children.items():
+                if isinstance(child, ResourceTreeNode):
+                    out[name] = {}
+                    stack.append((child, out[name]))
+                else:
+                    out[name] = child.simplify()
         return ret
 
 class ResourceTreeSet(ResourceTree):
@@ -157,52 +202,91 @@ class ResourceTreeSet(ResourceTree):
     # Offset to the start of element data.
     baseOffset: int
     # Child elements as raw data.
-    elements: List[StructStream]
+    elements: Sequence[StructStream]
+
+    __slots__ = ("listOffset", "baseOffset", "elements")
 
     def __init__(self, stream: StructStream):
-        originalStream = stream.copy()
-        ResourceTree.__init__(self, stream)
+        start = stream.tell()
+        self.tag, self.size, count, self.baseOffset, self.listOffset = stream.take("IIIII")
         assert self.tag == 2, self.tag
         
         # For set nodes, the "size" field seems to be broken?
-        #originalStream = originalStream.takeFork(self.size)
+        #originalStream = stream.forkAt(start, self.size)
         
-        count, self.baseOffset, self.listOffset = stream.take("III")
         #print("ResourceTreeSet(count={}, base={}, list={})".format(count, self.baseOffset, self.listOffset))
-        baseData = originalStream.copy().skip(self.baseOffset)
-        listData = originalStream.copy().skip(self.listOffset)
-        if count > 1:
-            elementOffsets: List[int] = list(baseData.copy().take("{}I".format(count)))
-        elif count == 1:
-            elementOffsets = [baseData.copy().take("I")]
+        baseData = stream.forkAt(start + self.baseOffset)
+        listData = stream.forkAt(start + self.listOffset)
+        elementOffsets: Tuple[int, ...] = baseData.peekArray(count, "I")
+        
+        # Each element ends where the next one starts. The last one ends at the
+        # offset list if that comes after the data, otherwise at the end of the
+        # buffer.
+        if self.listOffset < self.baseOffset:
+            #print("baseOffset", self.baseOffset, "is after listOffset", self.listOffset)
+            lastEnd = self.baseOffset - self.listOffset
         else:
-            elementOffsets = []
+            #print("Next offset is unknown. Using rest of buffer")
+            lastEnd = None
         
-        self.elements: List[StructStream] = []
-        for i, currentOffset in enumerate(elementOffsets):
-            elementStart = listData.copy().skip(currentOffset)
-            if i < len(elementOffsets) - 1:
-                nextOffset = elementOffsets[i + 1]
-                elementLength = nextOffset - currentOffset
-                #print("Next element offset", nextOffset)
-                self.elements.append(elementStart.takeFork(elementLength))
-            elif self.listOffset < self.baseOffset:
-                nextOffset = self.baseOffset - self.listOffset
-                elementLength = nextOffset - currentOffset
-                #print("baseOffset", self.baseOffset, "is after listOffset", self.listOffset, "final offset", nextOffset)
-                self.elements.append(elementStart.takeFork(elementLength))
-            else:
-                #print("Next offset is unknown. Using rest of buffer", len(listData) - currentOffset)
-                self.elements.append(elementStart)
+        # Element streams are only built when they're accessed.
+        self.elements: Sequence[StructStream] = _LazyElements(listData, elementOffsets, lastEnd)
         
 
         #if len(baseData) + 20 != self.size:
         #    print("ResourceTreeSet(count={}, base={}, list={})".format(count, self.baseOffset, self.listOffset))
         #    print("Mismatched set node size; expected", len(baseData) + 20, "found", self.size)
 
-    def simplify(self) -> list:
+    def simplify(self) -> Sequence[StructStream]:
         return self.elements
 
+class _LazyElements(collections.abc.Sequence):
+    """
+    The elements of a ResourceTreeSet or ResourceTreeArray. Each element stream
+    is a window into the node's data, built (and then kept) the first time it's
+    accessed. Slicing returns a plain list.
+
+    This is a read-only Sequence, not a list; use `list()` for a copy that
+    supports `+`, `append` and list equality.
+    """
+
+    __slots__ = ("_listData", "_offsets", "_lastEnd", "_cache")
+
+    def __init__(self, listData: StructStream, offsets: Sequence[int], lastEnd: Optional[int]):
+        self._listData = listData
+        self._offsets = offsets
+        self._lastEnd = lastEnd
+        self._cache: List[Optional[StructStream]] = [None] * len(offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        element = self._cache[index]
+        if element == None:
+            element = self._cache[index] = self._build(index % len(self))
+        return element
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def _build(self, index: int) -> StructStream:
+        currentOffset = self._offsets[index]
+        if index + 1 < len(self._offsets):
+            nextOffset = self._offsets[index + 1]
+        else:
+            nextOffset = self._lastEnd
+        
+        if nextOffset == None:
+            return self._listData.forkAt(currentOffset)
+        return self._listData.forkAt(currentOffset, nextOffset - currentOffset)
+
 class ResourceTreeArray(ResourceTree):
     """
     An Array node contains a list of data with fixed sizes.
@@ -216,22 +300,30 @@ class ResourceTreeArray(ResourceTree):
     """
     elementCount: int
     elementSize: int
-    elements: List[StructStream]
+    elements: Sequence[StructStream]
+
+    __slots__ = ("elementCount", "elementSize", "elements")
 
     def __init__(self, stream: StructStream):
-        originalStream = stream.copy()
-        ResourceTree.__init__(self, stream)
+        start = stream.tell()
+        self.tag, self.size, self.elementCount, self.elementSize, offset = stream.take("IIIII")
         assert self.tag == 1, self.tag
         
-        originalStream = originalStream.takeFork(self.size)
-        
-        self.elementCount, self.elementSize, offset = stream.take("III")
-        elementData = originalStream.takeFork(self.size).skip(offset)
-        self.elements: List[StructStream] = [elementData.takeFork(self.elementSize) for _ in range(self.elementCount)]
+        # Like a Set's, element streams are only built when they're accessed.
+        elementData = stream.forkAt(start + offset, self.size - offset)
+        elementOffsets = [i * self.elementSize for i in range(self.elementCount)]
+        self.elements: Sequence[StructStream] = _LazyElements(elementData, elementOffsets, self.elementCount * self.elementSize)
 
-    def simplify(self) -> list:
+    def simplify(self) -> Sequence[StructStream]:
         return self.elements
 
+# The ResourceTree subclass for each known `tag`, used by `parseFromStream`.
+_NODE_CLASSES = {
+    0: ResourceTreeNode,
+    1: ResourceTreeArray,
+    2: ResourceTreeSet,
+}
+
 #######################
 # Filesystem built on top of Resource Tree Format
 
@@ -248,7 +340,7 @@ class ResourceMap:
         #assert "l" in root, root
         assert "r" in root, root
         if "l" in root:
-            subFileNames: List[str] = [s.peekNullTermString().decode('ascii') for s in root["l"]]
+            subFileNames: List[str] = [_decodeName(s.peekNullTermString()) for s in root["l"]]
         else:
             subFileNames = list(range(len(root["r"])))
         self.subFiles: Dict[str, ResourceMapFileEntry] = {}
@@ -256,44 +348,44 @@ class ResourceMap:
         for i, name in enumerate(subFileNames):
             self.subFiles[name] = ResourceMapFileEntry(name, root["r"][i])
         
-        subFileNames.sort(key=lambda f: self.subFiles[f].blockOffset)
-        self.sortedFiles = [self.subFiles[name] for name in subFileNames]
+        # attrgetter keeps the sort key in C. The sort is stable, so files at
+        # the same offset stay in name-list order.
+        self.sortedFiles = sorted((self.subFiles[name] for name in subFileNames), key=operator.attrgetter("blockOffset"))
         del subFileNames
         
-        for i in range(len(self.sortedFiles) - 1):
-            subFile = self.sortedFiles[i]
-            nextSubFile = self.sortedFiles[i + 1]
+        # Each file ends where the next one starts. The last one runs to the end
+        # of the real file.
+        endBlocks = [f.blockOffset for f in itertools.islice(self.sortedFiles, 1, None)]
+        endBlocks.append(None)
+        for subFile, nextSubFile in zip(self.sortedFiles, itertools.islice(self.sortedFiles, 1, None)):
             subFile.nextFile = nextSubFile
-            endBlock = nextSubFile.blockOffset
+        for subFile, endBlock in zip(self.sortedFiles, endBlocks):
             subFile.sectors = realFile.sectors[subFile.blockOffset:endBlock]
             #print(subFile.name, "start", subFile.blockOffset, "end", endBlock, "length", len(subFile.sectors))
-        lastSubFile = self.sortedFiles[-1]
-        lastSubFile.sectors = realFile.sectors[lastSubFile.blockOffset:]
-        #print(lastSubFile.name, "start", lastSubFile.blockOffset, "length", len(lastSubFile.sectors))
         
         def handleSizeArray(name: str):
             if name not in root:
                 return
             
+            # Only the files before the first one without this kind get sizes.
+            starts = []
+            for f in self.sortedFiles:
+                index = f.sizeIndex[name]
+                if index == 0xFFFF:
+                    break
+                starts.append(index)
+            if len(starts) == 0:
+                return
+            
             # Array of bytes
             sizes = list(root[name][0].takeAll())
             #print("array", name, "sizes", sizes)
             
-            for i in range(len(self.sortedFiles)):
-                f = self.sortedFiles[i]
-                thisIndex = f._getSizeIndex(name)
-                if thisIndex == 0xFFFF:
-                    return
-                
-                if i == len(self.sortedFiles) - 1:
-                    nextIndex = len(sizes)
-                else:
-                    nextF = self.sortedFiles[i + 1]
-                    nextIndex = nextF._getSizeIndex(name)
-                    if nextIndex == 0xFFFF:
-                        nextIndex = len(sizes)
-                
-                f._setSizes(name, sizes[thisIndex:nextIndex])
+            # Each file's sizes end where the next file's start. The last one
+            # runs to the end of the array.
+            ends = starts[1:] + [len(sizes)]
+            for f, start, end in zip(self.sortedFiles, starts, ends):
+                f._setSizes(name, sizes[start:end])
         
         handleSizeArray("v")
         handleSizeArray("a")
@@ -308,16 +400,46 @@ class ResourceMap:
         return ret
         
     
+def _sizesAlias(name: Literal["v", "a", "d"]) -> property:
+    """A property for `sizes[name]`, under its old attribute name."""
+    def get(self: "ResourceMapFileEntry") -> List[int]:
+        return self.sizes[name]
+    def set(self: "ResourceMapFileEntry", sizes: List[int]):
+        self._setSizes(name, sizes)
+    return property(get, set)
+
+def _sizeIndexAlias(name: Literal["v", "a", "d"]) -> property:
+    """A property for `sizeIndex[name]`, under its old attribute name."""
+    def get(self: "ResourceMapFileEntry") -> int:
+        return self.sizeIndex[name]
+    def set(self: "ResourceMapFileEntry", index: int):
+        self.sizeIndex[name] = index
+    return property(get, set)
+
 class ResourceMapFileEntry:
     name: str
     channel: int
     blockOffset: int
-    sectors: List["CdiSector"]
     nextFile: Optional[Self]
     videoRecords: List[int]
     audioRecords: List[int]
     dataRecords: List[int]
-    _cachedRecordData: Dict[str, Dict[int, bytes]]
+    # The record sizes of each kind, keyed by "v", "a" or "d".
+    sizes: Dict[str, List[int]]
+    # Where each kind's sizes start in the map's size array. 0xFFFF if the
+    # file has none.
+    sizeIndex: Dict[str, int]
+    # Records that have been read, keyed by (kind, index). Records never change
+    # once read, so each one is only built once.
+    _cachedRecordData: Dict[Tuple[str, int], bytes]
+    # Running totals of each sizes list, so record `i` starts at `_sizeStarts[name][i]`.
+    _sizeStarts: Dict[str, List[int]]
+    # The data of each kind of sector, filtered from `sectors` the first time it's needed.
+    _dataByKind: Dict[str, List[bytes]]
+    
+    __slots__ = ("name", "channel", "blockOffset", "_sectors", "_dataByKind", "nextFile",
+        "videoRecords", "audioRecords", "dataRecords", "_cachedRecordData", "_sizeStarts",
+        "sizes", "sizeIndex")
     
     def __init__(self, name: str, stream: StructStream):
         self.name = name
@@ -327,58 +449,62 @@ class ResourceMapFileEntry:
         self.videoRecords = []
         self.audioRecords = []
         self.dataRecords = []
-        self._cachedRecordData: Dict[str, Dict[int, bytes]] = {}
+        self._cachedRecordData: Dict[Tuple[str, int], bytes] = {}
+        self._sizeStarts: Dict[str, List[int]] = {}
+        self.sizes = {"v": [], "a": [], "d": []}
+        self.sizeIndex = {}
         if len(stream) == 6:
             # There are still 6 bytes left.
             
-            self.videoSizesIndex, self.audioSizesIndex, self.dataSizesIndex = stream.take("HHH")
-            self.videoSizes: List[int] = []
-            self.audioSizes: List[int] = []
-            self.dataSizes: List[int] = []
+            self.sizeIndex["v"], self.sizeIndex["a"], self.sizeIndex["d"] = stream.take("HHH")
         else:
             print("6-byte file descriptors found:", len(stream))
     
+    videoSizes = _sizesAlias("v")
+    audioSizes = _sizesAlias("a")
+    dataSizes = _sizesAlias("d")
+    videoSizesIndex = _sizeIndexAlias("v")
+    audioSizesIndex = _sizeIndexAlias("a")
+    dataSizesIndex = _sizeIndexAlias("d")
+    
+    @property
+    def sectors(self) -> List["CdiSector"]:
+        return self._sectors
+    
+    @sectors.setter
+    def sectors(self, sectors: List["CdiSector"]):
+        self._sectors = sectors
+        self._dataByKind = {}
+    
     def getBytes(self, start = 0, end = None, kind = None):
-        if end == None:
-            end = len(self.sectors)
-        filtered = [s for s in self.sectors if kind == None or kind == s.kind]
-        return b''.join([s.data for s in filtered[start:end]])
+        if kind == None:
+            selected = self.sectors[start:end]
+            # A CdiSectorList can hand out its data without building sectors.
+            if hasattr(selected, "payloads"):
+                return b''.join(selected.payloads())
+            return b''.join([s.data for s in selected])
+        if kind not in self._dataByKind:
+            self._dataByKind[kind] = [s.data for s in self.sectors if s.kind == kind]
+        return b''.join(self._dataByKind[kind][start:end])
     
     def getRecord(self, index: int, kind: Literal["video","audio","data"]):
         assert kind in ["video", "audio", "data"]
-        if kind not in self._cachedRecordData:
-            self._cachedRecordData[kind] = {}
-        if index not in self._cachedRecordData[kind]:
-            sizes = self._getSizes(kind[0])
-            start = sum(sizes[:index])
-            size = sizes[index]
-            data = self.getBytes(start, start + size, kind = kind)
-            self._cachedRecordData[kind][index] = data
-        return self._cachedRecordData[kind][index]
-    
-    def _getSizeIndex(self, name: Literal["v", "a", "d"]) -> int:
-        if name == "v":
-            return self.videoSizesIndex
-        elif name == "a":
-            return self.audioSizesIndex
-        else:
-            assert name == "d"
-            return self.dataSizesIndex
+        sizes = self.sizes[kind[0]]
+        # The starts list has one more entry than sizes, so negative indexes
+        # have to be resolved against sizes first. This also means -1 and the
+        # last index share a cache entry.
+        index = range(len(sizes))[index]
+        key = (kind, index)
+        if key not in self._cachedRecordData:
+            start = self._getSizeStarts(kind[0])[index]
+            self._cachedRecordData[key] = self.getBytes(start, start + sizes[index], kind = kind)
+        return self._cachedRecordData[key]
     
     def _setSizes(self, name: Literal["v", "a", "d"], sizes: List[int]):
-        if name == "v":
-            self.videoSizes = sizes
-        elif name == "a":
-            self.audioSizes = sizes
-        else:
-            assert name == "d"
-            self.dataSizes = sizes
+        self._sizeStarts.pop(name, None)
+        self.sizes[name] = sizes
     
-    def _getSizes(self, name: Literal["v", "a", "d"]) -> List[int]:
-        if name == "v":
-            return self.videoSizes
-        if name == "a":
-            return self.audioSizes
-        assert name == "d"
-        return self.dataSizes
-
+    def _getSizeStarts(self, name: Literal["v", "a", "d"]) -> List[int]:
+        if name not in self._sizeStarts:
+            self._sizeStarts[name] = list(itertools.accumulate(self.sizes[name], initial=0))
+        return self._sizeStarts[name]
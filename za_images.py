@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from typing import Literal, Tuple, List, Union, TYPE_CHECKING, TypeVar
 from dataclasses import dataclass
-
+import struct
 
 import PIL.Image
 
@@ -11,6 +11,9 @@ from struct_stream import StructStream
 if TYPE_CHECKING:
     from za_lib import ActorDescription
 
+# A sprite packet header: (skiplen, size).
+_PACKET = struct.Struct(">HH")
+
 def decompressSprite(stream: StructStream, palette: bytes, paletteMode: Literal["RGB", "RGBA"]):
     """
     Decompresses zelda sprite storage format.
@@ -23,18 +26,29 @@ def decompressSprite(stream: StructStream, palette: bytes, paletteMode: Literal[
     # The sprite starts with the number of bytes to decompress.
     byteCount: int = stream.take("I")
 
-    # Split that data into a separate stream.
-    stream = stream.takeFork(byteCount)
+    # Split that data into a separate buffer.
+    data = memoryview(stream.takeRaw(byteCount))
 
     # The data is composed of packets of (skiplen, size) pairs.
     # The packet means "skip `skiplen` bytes, then copy `size * 4` bytes."
-    pixels = b''
-    while stream.peekRaw(4) != b'\0\0\0\0':
-        skip, size = stream.take("HH")
-        pixels += b'\0' * skip
-        pixels += stream.takeRaw(size * 4)
+    # A packet of all zeros ends the data.
+    #
+    # The first pass only finds where each packet's pixels go, so the output
+    # can be allocated once.
+    packets = []
+    length = 0
+    pos = 0
+    while True:
+        skip, size = _PACKET.unpack_from(data, pos)
+        if skip == 0 and size == 0:
+            break
+        pos += 4
+        copied = data[pos:pos + size * 4]
+        packets.append((length + skip, copied))
+        length += skip + len(copied)
+        pos += size * 4
     
-    if len(pixels) == 0:
+    if length == 0:
         # Blank image. PIL doesn't alllow images with a width or height of
         # zero, so return a 1x1 transparent image instead.
         return PIL.Image.frombytes("RGBA", (1, 1), b'\0\0\0\0')
@@ -44,26 +58,23 @@ def decompressSprite(stream: StructStream, palette: bytes, paletteMode: Literal[
     # the context needed to figure out the true intended width, so we make
     # it as thin as possible while preserving the upper left corner.
     #
-    # First, pad the bytes to a multiple of the screen width (384).
-    partialRow = len(pixels) % 384
-    pixels += b'\0' * (384 - partialRow)
-
-    # Then split the image into rows.
-    rows = [pixels[i * 384:(i + 1) * 384] for i in range(len(pixels)//384)]
-
-    # Find the longest row, which is the minimum width for the image.
-    maxWidth = 0
-    for row in rows:
-        for i, b in enumerate(row):
-            if b != 0:
-                maxWidth = max(maxWidth, i)
-
-    # Crop the image and recombine the rows into a single stream.
-    trimmedRows = [row[:maxWidth] for row in rows]
-    pixels = b''.join(trimmedRows)
-
-    # Finally, output the image with the provided palette.
-    img = PIL.Image.frombytes("P", (maxWidth, len(rows)), pixels)
+    # First, pad the bytes to a multiple of the screen width (384). Skipped
+    # bytes and padding are already zero.
+    pixels = bytearray(length + 384 - length % 384)
+    for start, copied in packets:
+        pixels[start:start + len(copied)] = copied
+
+    # Then load it as a full-width image. The image shares the buffer instead
+    # of copying it; cropping makes the copy.
+    img = PIL.Image.frombuffer("P", (384, len(pixels) // 384), pixels, "raw", "P", 0, 1)
+
+    # Find the longest row, which is the minimum width for the image. The width
+    # is the index of the last nonzero pixel in any row (0 if there are none).
+    bbox = img.getbbox()
+    maxWidth = 0 if bbox == None else bbox[2] - 1
+
+    # Finally, crop the image and output it with the provided palette.
+    img = img.crop((0, 0, maxWidth, img.height))
     img.putpalette(palette, paletteMode)
     return img
 
@@ -83,7 +94,7 @@ def unpackPointerArray(stream: StructStream) -> PointerArray:
     length, unusedPointer = stream.take("II")
     
     # First get the array of pointers to data regions.
-    offsets = [stream.take("I") for _ in range(length)]
+    offsets = stream.takeArray(length, "I")
 
     # Then assume the elements are densely packed, so all bytes between pointers
     # belong to one element. Also assume that elements do not overlap, and that
@@ -91,7 +102,7 @@ def unpackPointerArray(stream: StructStream) -> PointerArray:
     # are stored in sorted order.
     #
     # It's a lot of assumptions but it works out.
-    elements = [stream.takeFork(offsets[i + 1] - offsets[i]) for i in range(len(offsets) - 1)]
+    elements = [stream.takeFork(end - start) for start, end in zip(offsets, offsets[1:])]
     elements.append(stream.fork())
     return PointerArray(elements, unusedPointer)
 
@@ -140,10 +151,21 @@ def convertClutToRgba(clut: bytes, indices: List[int] = [], tColors: List[bytes]
     their index is in the `indices` array. Otherwise they are unchanged.
     """
     assert len(indices) > 0 or len(tColors) > 0, "Need to provide indices or colors"
-    paletteColors = [clut[i:i+3] for i in range(0, len(clut), 3)]
-    for i in range(len(paletteColors)):
-        opacity = b'\xFF'
-        if i in indices or paletteColors[i] in tColors:
-            opacity = b'\0'
-        paletteColors[i] = paletteColors[i] + opacity
-    return b''.join(paletteColors)
\ No newline at end of file
+    # Every color (including a trailing partial one) gains an opaque alpha byte.
+    count = len(clut) // 3
+    rgba = bytearray(b'\xFF' * (len(clut) + (len(clut) + 2) // 3))
+    for channel in range(3):
+        rgba[channel:count * 4:4] = clut[channel:count * 3:3]
+    rest = clut[count * 3:]
+    rgba[count * 4:count * 4 + len(rest)] = rest
+
+    # Then clear the alpha of the transparent ones.
+    transparentIndices = set(indices)
+    transparentColors = set(map(bytes, tColors))
+    # Slices have to be hashable to look them up.
+    clut = bytes(clut)
+    for i in range((len(clut) + 2) // 3):
+        color = clut[i * 3:i * 3 + 3]
+        if i in transparentIndices or color in transparentColors:
+            rgba[i * 4 + len(color)] = 0
+    return bytes(rgba)
\ No newline at end of file
@@ -870,7 +870,7 @@ class Game:
         file = self._voiceFiles.subFiles[globalId]
         sectors = self._voiceFiles.realFile.sectors[file.blockOffset:]
         foundFile = saveSoundFile(sectors, 1 << (file.channel & 0x7F), filename)
-        assert foundFile, (globalId, filename, file.__dict__)
+        assert foundFile, (globalId, filename, file.name, file.channel, file.blockOffset)
 
 class Attack:
     """